@@ -10,59 +10,229 @@ Create GeoJSON tile of S1 burst map for GSIMaps from kmz files.
 import argparse
 import sys
 import os
+import math
 import time
 import datetime
 import glob
 import shutil
-import json
-import subprocess
+import re
+import multiprocessing
+import zipfile
+import pickle
+import hashlib
 import numpy as np
 
+try: # lxml parses faster than stdlib ElementTree
+    from lxml import etree
+except ImportError:
+    import xml.etree.ElementTree as etree
+
+try: # orjson/ujson are a few times faster than stdlib json
+    import orjson
+except ImportError:
+    orjson = None
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+
+try: # numba JIT-compiles the scalar tile ID math
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs): # no-op decorator
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# %% Settings
+colorA = "#0000ff"
+colorD = "#ff0000"
+line_opacity = 0.4
+line_width = 1
+fill_opacity = 0.1
+bname = 'S1burst'
+
+# Extract orb, bid, swath from the description HTML in one scan
+# (value cells sit after the 11th, 17th and 23rd '>' in the table)
+_DESCR_RE = re.compile(
+    r'(?:[^>]*>){11}([^<>]*)(?:[^>]*>){6}([^<>]*)(?:[^>]*>){6}([^<>]*)')
+
 class Usage(Exception):
     """Usage context manager"""
     def __init__(self, msg):
         self.msg = msg
 
 
+# %% json helpers
+def json_dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
 # %% latlon2tileid
-def latlon2tileid(lat, lon, zl):
+@njit(cache=True)
+def latlon2tileid(lat, lon, kx, ky):
+    # Scalar version; the main loop uses the vectorized expressions below.
+    # kx = (1<<zl)/2 and ky = (1<<zl)/(2*pi), precomputed once per zl
     # https://www.trail-note.net/tech/coordinate/
     # https://note.sngklab.jp/?p=72
 
-    x = int((lon/180+1)*2**zl/2)
-    y = int(((-np.log(np.tan(np.deg2rad(45+lat/2)))+np.pi)*2**zl/(2*np.pi)))
+    x = int((lon/180+1)*kx)
+    y = int((-math.log(math.tan(math.radians(45+lat/2)))+math.pi)*ky)
 
     return x, y
 
 
-# %% add_feature
-def add_feature(feature, geojson):
-    if not os.path.exists(geojson):
-        os.makedirs(os.path.dirname(geojson), exist_ok=True)
-        with open(geojson, 'x') as f:
-            json.dump({'type': 'FeatureCollection', 'features': []}, f)
-
-    with open(geojson, 'r') as f:
-        json_dict = json.load(f)
-        features_list = json_dict['features']
+# %% latlon2tileid_array
+def latlon2tileid_array(lats, lons, zl):
+    # Vectorized latlon2tileid for all features at once
+    kx = (1<<zl)/2
+    ky = (1<<zl)/(2*np.pi)
+    xs = ((lons/180+1)*kx).astype(np.int64)
+    ys = ((-np.log(np.tan(np.deg2rad(45+lats/2)))+np.pi)
+          *ky).astype(np.int64)
+
+    return xs, ys
+
+
+# %% read_kmz
+_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'S1burst')
+
+def read_kmz(kmz):
+    # Read burst features from doc.kml in the kmz directly, without the
+    # ogr2ogr subprocess and intermediate geojson file. Parsed features
+    # are cached on disk keyed by kmz path+mtime so that unchanged kmzs
+    # are not re-parsed on incremental runs.
+    key = hashlib.md5(
+        kmz.encode()+str(os.path.getmtime(kmz)).encode()).hexdigest()
+    cache_pkl = os.path.join(_cache_dir, f'{key}.pkl')
+    if os.path.exists(cache_pkl):
+        try:
+            with open(cache_pkl, 'rb') as f:
+                return pickle.load(f)
+        except Exception: # corrupt/truncated cache, fall back to parsing
+            pass
+
+    ns = '{http://www.opengis.net/kml/2.2}'
+    features_list = []
+    with zipfile.ZipFile(kmz) as z, z.open('doc.kml') as f:
+        tree = etree.parse(f)
+
+    for pm in tree.iterfind(f'.//{ns}Placemark'):
+        descr = pm.findtext(f'{ns}description')
+        coord_text = pm.findtext(f'.//{ns}coordinates')
+        ring = np.array(coord_text.replace(',', ' ').split(),
+                        dtype=np.float64).reshape(-1, 3)
+        features_list.append(
+            {'type': 'Feature',
+             'properties': {'description': descr},
+             'geometry': {'type': 'Polygon',
+                          'coordinates': [ring.tolist()]}})
+
+    # Write atomically so an interrupted run cannot leave a truncated
+    # pickle behind under a valid key
+    os.makedirs(_cache_dir, exist_ok=True)
+    cache_tmp = f'{cache_pkl}.{os.getpid()}.tmp'
+    with open(cache_tmp, 'wb') as f:
+        pickle.dump(features_list, f)
+    os.replace(cache_tmp, cache_pkl)
+
+    return features_list
+
+
+# %% append_feature
+def append_feature(buffers, geojson, feature):
+    # feature is already serialized to JSON bytes
+    buffers.setdefault(geojson, []).append(feature)
+
+
+# %% flush_buffers
+_existing_dirs = set() # skip makedirs syscalls for already created dirs
+
+def flush_buffers(buffers):
+    for geojson, features_list in buffers.items():
+        tiledir = os.path.dirname(geojson)
+        if tiledir not in _existing_dirs:
+            os.makedirs(tiledir, exist_ok=True)
+            _existing_dirs.add(tiledir)
+        with open(geojson, 'wb') as f:
+            f.write(b'{"type":"FeatureCollection","features":['
+                    + b','.join(features_list) + b']}')
+
+
+# %% process_kmz
+def process_kmz(kmz, zl):
+    print(f'{kmz}')
+    start1 = time.time()
+
+    # %% Read bursts from kmz
+    path = os.path.basename(kmz)[0:3]
+    i = np.mod(int(path), 5) #1-5
+    if i == 0: i = 5
+
+    features_list = read_kmz(kmz)
+    n_feature = len(features_list)
+    print(f'n_feature: {n_feature}')
+
+
+    # %% Column arrays instead of per-feature dict lookups
+    descrs = [f['properties']['description'] for f in features_list]
+    geoms = [f['geometry'] for f in features_list]
+    first_pts = np.array([g['coordinates'][0][0] for g in geoms])
+    lats = first_pts[:, 1] if n_feature else first_pts
+    lons = first_pts[:, 0] if n_feature else first_pts
+
+
+    # %% Tile IDs for all bursts at once
+    xs, ys = latlon2tileid_array(lats, lons, zl)
+    xs_s = xs.astype(str) # stringify once in C for the tile paths
+    ys_s = ys.astype(str)
+
+
+    # %% For each burst
+    # Tile paths use '/' on purpose; they are web tile paths
+    prefix = {AD: f'{bname}{AD}{i}/{zl}' for AD in ['A', 'D']}
+    buffers = {} # tile path -> serialized features of this kmz
+    for i_f in range(n_feature):
+        if lats[i_f] > 84 or lats[i_f] < -84: # cannot display on web map
+            continue
+
+        orb, bid, swath = _DESCR_RE.match(descrs[i_f]).groups()
+#        tanx = descrs[i_f].split('>')[29].split('<')[0]
+        if orb == 'ASCENDING':
+            AD = 'A'
+            color = colorA
+        elif orb == 'DESCENDING':
+            AD = 'D'
+            color = colorD
+        else:
+            raise ValueError(f'orb {orb} is not ASCENDING or DESCENDING!')
+
+        name = f'{path}{AD} {swath} {bid}'
+        geometry = geoms[i_f]
+
+#        properties = {"name": name, "Burst ID": bid,
+#                      "Time from ANX [s]": tanx,
+        properties = {"name": name,
+                      "_color": color, "_opacity": line_opacity,
+                       "_weight": line_width, "_fillColor": color,
+                       "_fillOpacity": fill_opacity}
+        out_feature = {'type': 'Feature', 'properties': properties,
+                       'geometry': geometry}
+
+        # Add feature to its tile
+        out_jsonfile = f'{prefix[AD]}/{xs_s[i_f]}/{ys_s[i_f]}.geojson'
+        append_feature(buffers, out_jsonfile, json_dumps(out_feature))
+
 
-    features_list.append(feature)
+    elapsed_time1 = datetime.timedelta(seconds=(time.time()-start1))
+    print(f"  Elapsed time: {elapsed_time1}")
 
-    with open(geojson, 'w') as f:
-        json.dump({'type': 'FeatureCollection', 'features': features_list}, f)
+    return buffers
 
 
 # %% Main
 def main(argv=None):
 
-    # %% Settings
-    colorA = "#0000ff"
-    colorD = "#ff0000"
-    line_opacity = 0.4
-    line_width = 1
-    fill_opacity = 0.1
-
-
     # %% Read arg
     start = time.time()
     prog = os.path.basename(sys.argv[0])
@@ -84,90 +254,30 @@ def main(argv=None):
 
 
     # %% Output geojson tile dirs
-    bname = 'S1burst'
     for i in range(1, 5):
         for AD in ['A', 'D']:
             bdir = bname+f'{AD}{i}'
             if os.path.exists(bdir):
-#                shutil.rmtree(bdir)
-                subprocess.run(['rm', '-rf', bdir])
+                shutil.rmtree(bdir, ignore_errors=True)
             zldir = os.path.join(bdir, str(zl))
             os.makedirs(zldir)
 #            zl1dir = os.path.join(bdir, '1', '1') # For low ZL
 #            os.makedirs(zl1dir)
 
 
-    # %% For each input kmz files
-    for kmz in glob.glob(os.path.join(kmz_dir, '*.kmz')):
-        print(f'{kmz}')
-        start1 = time.time()
-
-        # %% Convert kmz to geosjon
-        geojson = os.path.basename(kmz).replace('.kmz', '.geojson')
-        if os.path.exists(geojson): os.remove(geojson)
-        subprocess.run(['ogr2ogr', geojson, kmz])
-        path = geojson[0:3]
-        i = np.mod(int(path), 5) #1-5
-        if i == 0: i = 5
-
-
-        # %% Read json
-        with open(geojson, 'r') as f:
-            json_dict = json.load(f)
-
-        features_list = json_dict['features']
-        print(f'n_feature: {len(features_list)}')
-
-
-        # %% For each burst
-        for feature in features_list:
-            descr = feature['properties']['description']
-            orb = descr.split('>')[11].split('<')[0]
-            bid = descr.split('>')[17].split('<')[0]
-            swath = descr.split('>')[23].split('<')[0]
-#            tanx = descr.split('>')[29].split('<')[0]
-            if orb == 'ASCENDING':
-                AD = 'A'
-                color = colorA
-            elif orb == 'DESCENDING':
-                AD = 'D'
-                color = colorD
-            else:
-                raise ValueError(f'orb {orb} is not ASCENDING or DESCENDING!')
-
-            name = f'{path}{AD} {swath} {bid}'
-            geometry = feature['geometry']
-            lat = geometry['coordinates'][0][0][1]
-            lon = geometry['coordinates'][0][0][0]
-
-            if lat > 84 or lat < -84: # cannot display on web map
-                continue
-
-#            properties = {"name": name, "Burst ID": bid,
-#                          "Time from ANX [s]": tanx,
-            properties = {"name": name,
-                          "_color": color, "_opacity": line_opacity,
-                           "_weight": line_width, "_fillColor": color,
-                           "_fillOpacity": fill_opacity}
-            out_feature = {'type': 'Feature', 'properties': properties,
-                           'geometry': geometry}
-
-            # Identify tile ID
-            x, y = latlon2tileid(lat, lon, zl)
-
-            # Add feature
-            out_jsonfile = os.path.join(bname+f'{AD}{i}', str(zl), str(x),
-                                        str(y)+'.geojson')
-            add_feature(out_feature, out_jsonfile)
-
-
-        # %% Make dissolved geojson
-        # Need to exclude poles
-
-        # %% Remove geojson
-        os.remove(geojson)
-        elapsed_time1 = datetime.timedelta(seconds=(time.time()-start1))
-        print(f"  Elapsed time: {elapsed_time1}")
+    # %% For each input kmz files (in parallel)
+    kmz_files = glob.glob(os.path.join(kmz_dir, '*.kmz'))
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        buffers_list = pool.starmap(process_kmz,
+                                    [(kmz, zl) for kmz in kmz_files])
+
+    # %% Merge per-kmz buffers and write all tiles
+    buffers = {} # tile path -> serialized features, written once at the end
+    for buffers1 in buffers_list:
+        for out_jsonfile, features in buffers1.items():
+            buffers.setdefault(out_jsonfile, []).extend(features)
+
+    flush_buffers(buffers)
 
 
     # %% Finish
@@ -10,47 +10,148 @@ Create GeoJSON tile of S1 burst map at ZL=1 for GSIMaps from kmz files.
 import argparse
 import sys
 import os
+import math
 import time
 import datetime
 import glob
-import json
-from shapely.geometry import Polygon, MultiPolygon
+import re
+import shapely
+from shapely.geometry import Polygon
 from shapely.ops import unary_union
-import subprocess
+import shutil
+import zipfile
+import pickle
+import hashlib
 import numpy as np
 
+try: # lxml parses faster than stdlib ElementTree
+    from lxml import etree
+except ImportError:
+    import xml.etree.ElementTree as etree
+
+try: # orjson/ujson are a few times faster than stdlib json
+    import orjson
+except ImportError:
+    orjson = None
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+
+try: # numba JIT-compiles the scalar tile ID math
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs): # no-op decorator
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# Extract orb from the description HTML in one scan
+# (the value cell sits after the 11th '>' in the table)
+_DESCR_RE = re.compile(r'(?:[^>]*>){11}([^<>]*)')
+
 class Usage(Exception):
     """Usage context manager"""
     def __init__(self, msg):
         self.msg = msg
 
 
+# %% json helpers
+def json_dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
 # %% latlon2tileid
-def latlon2tileid(lat, lon, zl):
+@njit(cache=True)
+def latlon2tileid(lat, lon, kx, ky):
+    # kx = (1<<zl)/2 and ky = (1<<zl)/(2*pi), precomputed once per zl
     # https://www.trail-note.net/tech/coordinate/
     # https://note.sngklab.jp/?p=72
 
-    x = int((lon/180+1)*2**zl/2)
-    y = int(((-np.log(np.tan(np.deg2rad(45+lat/2)))+np.pi)*2**zl/(2*np.pi)))
+    x = int((lon/180+1)*kx)
+    y = int((-math.log(math.tan(math.radians(45+lat/2)))+math.pi)*ky)
 
     return x, y
 
 
-# %% add_feature
-def add_feature(feature, geojson):
-    if not os.path.exists(geojson):
-        os.makedirs(os.path.dirname(geojson), exist_ok=True)
-        with open(geojson, 'x') as f:
-            json.dump({'type': 'FeatureCollection', 'features': []}, f)
-
-    with open(geojson, 'r') as f:
-        json_dict = json.load(f)
-        features_list = json_dict['features']
-
-    features_list.append(feature)
-
-    with open(geojson, 'w') as f:
-        json.dump({'type': 'FeatureCollection', 'features': features_list}, f)
+# %% read_kmz
+_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'S1burst')
+
+def read_kmz(kmz):
+    # Read burst features from doc.kml in the kmz directly, without the
+    # ogr2ogr subprocess and intermediate geojson file. Parsed features
+    # are cached on disk keyed by kmz path+mtime so that unchanged kmzs
+    # are not re-parsed on incremental runs.
+    key = hashlib.md5(
+        kmz.encode()+str(os.path.getmtime(kmz)).encode()).hexdigest()
+    cache_pkl = os.path.join(_cache_dir, f'{key}.pkl')
+    if os.path.exists(cache_pkl):
+        try:
+            with open(cache_pkl, 'rb') as f:
+                return pickle.load(f)
+        except Exception: # corrupt/truncated cache, fall back to parsing
+            pass
+
+    ns = '{http://www.opengis.net/kml/2.2}'
+    features_list = []
+    with zipfile.ZipFile(kmz) as z, z.open('doc.kml') as f:
+        tree = etree.parse(f)
+
+    for pm in tree.iterfind(f'.//{ns}Placemark'):
+        descr = pm.findtext(f'{ns}description')
+        coord_text = pm.findtext(f'.//{ns}coordinates')
+        ring = np.array(coord_text.replace(',', ' ').split(),
+                        dtype=np.float64).reshape(-1, 3)
+        features_list.append(
+            {'type': 'Feature',
+             'properties': {'description': descr},
+             'geometry': {'type': 'Polygon',
+                          'coordinates': [ring.tolist()]}})
+
+    # Write atomically so an interrupted run cannot leave a truncated
+    # pickle behind under a valid key
+    os.makedirs(_cache_dir, exist_ok=True)
+    cache_tmp = f'{cache_pkl}.{os.getpid()}.tmp'
+    with open(cache_tmp, 'wb') as f:
+        pickle.dump(features_list, f)
+    os.replace(cache_tmp, cache_pkl)
+
+    return features_list
+
+
+# %% rings2polygons
+def rings2polygons(rings):
+    # Build all polygons with one bulk C call (shapely 2.x) instead of
+    # crossing Python->GEOS once per ring
+    if not rings:
+        return []
+    if not hasattr(shapely, 'linearrings'): # shapely 1.x
+        return [Polygon(ring) for ring in rings]
+
+    coords = np.concatenate([np.asarray(ring) for ring in rings])
+    indices = np.repeat(np.arange(len(rings)),
+                        [len(ring) for ring in rings])
+    return shapely.polygons(shapely.linearrings(coords, indices=indices))
+
+
+# %% append_feature
+def append_feature(buffers, geojson, feature):
+    # feature is already serialized to JSON bytes
+    buffers.setdefault(geojson, []).append(feature)
+
+
+# %% flush_buffers
+_existing_dirs = set() # skip makedirs syscalls for already created dirs
+
+def flush_buffers(buffers):
+    for geojson, features_list in buffers.items():
+        tiledir = os.path.dirname(geojson)
+        if tiledir not in _existing_dirs:
+            os.makedirs(tiledir, exist_ok=True)
+            _existing_dirs.add(tiledir)
+        with open(geojson, 'wb') as f:
+            f.write(b'{"type":"FeatureCollection","features":['
+                    + b','.join(features_list) + b']}')
 
 
 # %% Main
@@ -88,66 +189,71 @@ def main(argv=None):
         for AD in ['A', 'D']:
             bdir = bname+f'{AD}{i}'
             if os.path.exists(bdir):
-                subprocess.run(['rm', '-rf', bdir])
+                shutil.rmtree(bdir, ignore_errors=True)
             zl1dir = os.path.join(bdir, '1', '1') # For low ZL
             os.makedirs(zl1dir, exist_ok=True)
 
 
     # %% For each input kmz files
+    buffers = {} # tile path -> serialized features, written once at the end
     for kmz in glob.glob(os.path.join(kmz_dir, '*.kmz')):
         print(f'{kmz}')
         start1 = time.time()
 
-        # %% Convert kmz to geosjon
-        geojson = os.path.basename(kmz).replace('.kmz', '.geojson')
-        if os.path.exists(geojson): os.remove(geojson)
-        subprocess.run(['ogr2ogr', geojson, kmz])
-        path = geojson[0:3]
+        # %% Read bursts from kmz
+        path = os.path.basename(kmz)[0:3]
         i = np.mod(int(path), 5) #1-5
         if i == 0: i = 5
 
+        features_list = read_kmz(kmz)
+        n_feature = len(features_list)
+        print(f'n_feature: {n_feature}')
 
-        # %% Read json
-        with open(geojson, 'r') as f:
-            json_dict = json.load(f)
 
-        features_list = json_dict['features']
-        print(f'n_feature: {len(features_list)}')
+        # %% Column arrays instead of per-feature dict lookups
+        descrs = [f['properties']['description'] for f in features_list]
+        rings = [f['geometry']['coordinates'][0] for f in features_list]
+        first_pts = np.array([ring[0] for ring in rings])
+        lats = first_pts[:, 1] if n_feature else first_pts
 
 
         # %% For each burst
-        polygonsA = [] # For dissolved geojson
-        polygonsD = []
+        ringsA = [] # Exterior rings for dissolved geojson
+        ringsD = []
 
-        for feature in features_list:
-            geometry = feature['geometry']
-            lat = geometry['coordinates'][0][0][1]
-            if lat > 84 or lat < -84: # cannot display on web map
+        for i_f in range(n_feature):
+            if lats[i_f] > 84 or lats[i_f] < -84: # cannot display on web map
                 continue
 
-            descr = feature['properties']['description']
-            orb = descr.split('>')[11].split('<')[0]
+            orb = _DESCR_RE.match(descrs[i_f]).group(1)
             if orb == 'ASCENDING':
-                AD = 'A'
-                color = colorA
-                polygonsA.append(Polygon(
-                    feature['geometry']['coordinates'][0]))
+                ringsA.append(rings[i_f])
             elif orb == 'DESCENDING':
-                AD = 'D'
-                color = colorD
-                polygonsD.append(Polygon(
-                    feature['geometry']['coordinates'][0]))
+                ringsD.append(rings[i_f])
             else:
                 raise ValueError(f'orb {orb} is not ASCENDING or DESCENDING!')
 
 
         # %% Make dissolved geojson
-        for AD, polygons in zip(['A', 'D'], [polygonsA, polygonsD]):
-            dissolved_poly = unary_union(MultiPolygon(polygons))
-            if dissolved_poly.type == 'Polygon': # 1 segment
-                dissolved_poly = [dissolved_poly]
-            for _poly in dissolved_poly:
-                poly2 = _poly.simplify(tolerance)
+        for AD, rings1 in zip(['A', 'D'], [ringsA, ringsD]):
+            color = colorA if AD == 'A' else colorD
+            polygons = rings2polygons(rings1)
+            # shapely >= 2.1 defines disjoint_subset_union_all even when
+            # the linked GEOS is too old, so check the GEOS version too
+            if (hasattr(shapely, 'disjoint_subset_union_all')
+                    and shapely.geos_version >= (3, 12, 0)):
+                # Much faster union for largely disjoint burst clusters
+                dissolved_poly = shapely.disjoint_subset_union_all(polygons)
+            else:
+                dissolved_poly = unary_union(polygons)
+            if dissolved_poly.geom_type == 'Polygon': # 1 segment
+                dissolved_polys = [dissolved_poly]
+            else:
+                dissolved_polys = dissolved_poly.geoms
+            for _poly in dissolved_polys:
+                # preserve_topology=False uses the much faster plain
+                # Douglas-Peucker; fine for coarse ZL=1 outlines
+                poly2 = _poly.simplify(tolerance, preserve_topology=False)
                 poly2_list = [list(i) for i in poly2.exterior.coords[:]]
                 print(f'Number of nodes: {len(poly2_list)}')
                 name2 = f'{path}{AD}'
@@ -162,15 +268,18 @@ def main(argv=None):
                 # Add feature
                 out_jsonfile = os.path.join(bname+f'{AD}{i}', '1', '1',
                                             '0.geojson')
-                add_feature(out_feature, out_jsonfile)
+                append_feature(buffers, out_jsonfile,
+                               json_dumps(out_feature))
 
 
-        # %% Remove geojson
-        os.remove(geojson)
         elapsed_time1 = datetime.timedelta(seconds=(time.time()-start1))
         print(f"  Elapsed time: {elapsed_time1}")
 
 
+    # %% Write all tiles
+    flush_buffers(buffers)
+
+
     # %% Finish
     elapsed_time = datetime.timedelta(seconds=(time.time()-start))
     print(f"\nElapsed time: {elapsed_time}")